@@ -45,10 +45,22 @@ conf.registerGlobalValue(Git, 'pollPeriod',
     registry.NonNegativeInteger(120, """The frequency (in seconds) repositories
         will be polled for changes.  Set to zero to disable polling."""))
 
+conf.registerGlobalValue(Git, 'pollBatchDivisor',
+    registry.PositiveInteger(1, """Split the repositories into this many
+        groups and only poll one group per period, in rotation.  With many
+        repositories, this bounds the work done each period, at the cost of
+        each repository being checked only every pollBatchDivisor
+        periods."""))
+
 conf.registerGlobalValue(Git, 'maxCommitsAtOnce',
     registry.NonNegativeInteger(5, """How many commits are displayed at
         once from each repository."""))
 
+conf.registerGlobalValue(Git, 'coalesceLines',
+    registry.Boolean(False, """Join the lines announcing new commits into as
+        few messages as possible (separated by ' | '), instead of sending
+        each line as its own message."""))
+
 conf.registerGlobalValue(Git, 'shaSnarfing',
     registry.Boolean(True, """Look for SHAs in user messages written to the
        channel, and reply with the commit description if one is found."""))
@@ -24,19 +24,27 @@
 A Supybot plugin that monitors and interacts with git repositories.
 """
 
+import supybot.conf as conf
 import supybot.utils as utils
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
-import supybot.schedule as schedule
 import supybot.log as log
 import supybot.world as world
 
+import collections
 import ConfigParser
-from functools import wraps
+import operator
 import os
+import Queue
+import re
+import shutil
+import signal
+import subprocess
+import tempfile
+import thread
 import threading
 import time
 import traceback
@@ -47,6 +55,96 @@ import traceback
 # (0.1.x, 0.3.x supported)
 GIT_API_VERSION = -1
 
+# Substitution tokens in the "commit message" and "commit link" templates.
+# For %(fg,bg), group 2 is empty if the closing parenthesis is missing.  An
+# unterminated color or a trailing % produces nothing, and an unknown %x
+# produces x.
+MESSAGE_TOKEN = re.compile(r'%(?:\(([^)]*)(\)?)|(.)|$)')
+LINK_TOKEN = re.compile(r'%(.|$)', re.DOTALL)
+
+# Substitutions that depend on the commit being formatted.  Everything else in
+# a template is fixed for a given repository, and is folded into literal text
+# when it's compiled.
+COMMIT_KEYS = frozenset('acCelm')
+LINK_KEYS = frozenset('cC')
+STATIC_SUBST = {
+    'r': '\x0f',
+    '!': '\x02',
+    '%': '%',
+}
+
+# Just what formatting needs from a commit, read straight from 'git log'
+# (see Repository._log_commits).  It has both 'id' and 'hexsha' so it's
+# accepted wherever a GitPython commit of either API version is.
+CommitAuthor = collections.namedtuple('CommitAuthor', 'name email')
+CommitInfo = collections.namedtuple('CommitInfo', 'id hexsha author message')
+
+# Opcodes of a compiled template (see compile_format)
+LITERAL, SUBST = 0, 1
+
+def compile_format(format_str, constants):
+    """
+    Parse a commit message template once, so that formatting a commit is just
+    a matter of filling in the blanks.  'constants' gives the values of the
+    repository's own substitutions (%b, %n, %s, %u).  Returns a list with one
+    program per output line, each a list of (LITERAL, text) and (SUBST, key)
+    operations, with adjacent literal text merged together.
+    """
+    program = []
+    for line in format_str.split('\n'):
+        ops = []
+        position = 0
+        for match in MESSAGE_TOKEN.finditer(line):
+            ops.append((LITERAL, line[position:match.start()]))
+            position = match.end()
+            color, closed, key = match.groups()
+            if color is not None:
+                if closed:
+                    ops.append((LITERAL, '\x03' + color))
+            elif key in constants:
+                ops.append((LITERAL, constants[key]))
+            elif key in COMMIT_KEYS:
+                ops.append((SUBST, key))
+            elif key is not None:
+                ops.append((LITERAL, STATIC_SUBST.get(key, key)))
+        ops.append((LITERAL, line[position:]))
+        program.append(merge_literals(ops))
+    return program
+
+def compile_link(link):
+    "Like compile_format, for a commit link (a single program)."
+    ops = []
+    position = 0
+    for match in LINK_TOKEN.finditer(link):
+        ops.append((LITERAL, link[position:match.start()]))
+        position = match.end()
+        key = match.group(1)
+        ops.append((SUBST if key in LINK_KEYS else LITERAL, key))
+    ops.append((LITERAL, link[position:]))
+    return merge_literals(ops)
+
+def merge_literals(ops):
+    "Drop empty literals from a template program and join adjacent ones."
+    result = []
+    for op, arg in ops:
+        if op == LITERAL:
+            if not arg:
+                continue
+            if result and result[-1][0] == LITERAL:
+                result[-1] = (LITERAL, result[-1][1] + arg)
+                continue
+        result.append((op, arg))
+    return result
+
+def program_keys(program):
+    "Return the set of substitutions a compiled template uses."
+    return frozenset([arg for ops in program for op, arg in ops
+                      if op == SUBST])
+
+def run_program(ops, subst):
+    "Fill in a compiled template program from the 'subst' dict."
+    return ''.join([subst[arg] if op == SUBST else arg for op, arg in ops])
+
 def log_info(message):
     log.info("Git: " + message)
 
@@ -67,27 +165,233 @@ def plural(count, singular, plural=None):
         return singular[:-1] + 'ies'
     return singular + 's'
 
-def synchronized(tlockname):
+# Used by coalesce_lines: the separator, and the longest message (in bytes) to
+# build, which leaves room for the rest of the PRIVMSG within IRC's 512.
+COALESCE_SEPARATOR = ' | '
+COALESCE_LIMIT = 400
+
+def coalesce_lines(lines):
+    """
+    Join consecutive lines into as few messages as possible, each no longer
+    than COALESCE_LIMIT (a line that is longer by itself is left alone).
+    """
+    result = []
+    for line in lines:
+        if result and (len(result[-1]) + len(COALESCE_SEPARATOR) + len(line)
+                       <= COALESCE_LIMIT):
+            result[-1] += COALESCE_SEPARATOR + line
+        else:
+            result.append(line)
+    return result
+
+def run_git(args, cwd, timeout):
+    """
+    Run a git command in the given directory and return its output.  If it
+    runs for more than 'timeout' seconds, it's killed (with any helpers it
+    started, such as ssh) and an exception is raised, as on failure.
+    """
+    if hasattr(os, 'setsid'):
+        preexec_fn = os.setsid # Own process group, to kill helpers too
+    else:
+        preexec_fn = None
+    process = subprocess.Popen(['git'] + args, cwd=cwd,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               preexec_fn=preexec_fn)
+    timed_out = []
+    def _kill():
+        timed_out.append(True)
+        try:
+            if preexec_fn:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass # Already gone
+    timer = threading.Timer(timeout, _kill)
+    timer.start()
+    try:
+        output, errors = process.communicate()
+    finally:
+        timer.cancel()
+    if timed_out:
+        raise Exception('git %s timed out after %d seconds' %
+                        (args[0], timeout))
+    if process.returncode:
+        raise Exception('git %s failed: %s' % (args[0], errors.strip()))
+    return output
+
+def next_batch(items, cursor, divisor):
+    """
+    Split items into 'divisor' roughly equal batches and return the one
+    starting at index 'cursor' (wrapping around), along with the cursor
+    for the following batch: (batch, cursor).
+    """
+    n = len(items)
+    if not n:
+        return [], 0
+    size = -(-n // divisor) # Round up
+    cursor %= n
+    batch = (items[cursor:] + items[:cursor])[:size]
+    return batch, (cursor + size) % n
+
+class _LockSide(object):
+    "One side (read or write) of an RWLock, as a context manager."
+
+    __slots__ = ('acquire', 'release')
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+class RWLock(object):
     """
-    Decorates a class method (with self as the first parameter) to acquire the
-    member variable lock with the given name (e.g. 'lock' ==> self.lock) for
-    the duration of the function (blocking).
+    A reentrant reader/writer lock.  Any number of threads may hold the read
+    side at once, while the write side is exclusive.  The thread holding the
+    write side may also take the read side, but a reader must not try to
+    upgrade to writing (it will deadlock).  Waiting writers block new readers
+    so that a steady stream of reads can't starve them.
     """
-    def _synched(func):
-        @wraps(func)
-        def _synchronizer(self, *args, **kwargs):
-            tlock = self.__getattribute__(tlockname)
-            tlock.acquire()
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {} # Thread ident => recursion depth
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        # For use in with-statements
+        self.reader = _LockSide(self.acquire_read, self.release_read)
+        self.writer = _LockSide(self.acquire_write, self.release_write)
+
+    def acquire_read(self, blocking=True):
+        me = thread.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return True
+            while self._writer is not None or self._writers_waiting:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self._readers[me] = 1
+            return True
+
+    def release_read(self):
+        me = thread.get_ident()
+        with self._cond:
+            if self._readers[me] > 1:
+                self._readers[me] -= 1
+            else:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self, blocking=True):
+        me = thread.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return True
+            self._writers_waiting += 1
             try:
-                return func(self, *args, **kwargs)
+                while self._writer is not None or self._readers:
+                    if not blocking:
+                        return False
+                    self._cond.wait()
             finally:
-                tlock.release()
-        return _synchronizer
-    return _synched
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+            return True
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if not self._writer_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+class LRUCache(object):
+    """
+    A small thread-safe mapping that holds at most 'capacity' entries,
+    discarding the least recently used one to make room for a new one.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
 class Repository(object):
     "Represents a git repository being monitored."
 
+    # There may be many of these, so skip the per-instance __dict__.
+    __slots__ = (
+        'branch',
+        'branch_display',
+        'catfile',
+        'catfile_lock',
+        'channels',
+        'checked_generation',
+        'commit_cache',
+        'commit_link',
+        'commit_message',
+        'commit_reply',
+        'message_keys',
+        'message_program',
+        'reply_keys',
+        'reply_program',
+        'errors',
+        'format_cache',
+        'generation',
+        'get_commit_id',
+        'last_commit',
+        'last_remote_heads',
+        'link_program',
+        'lock',
+        'long_name',
+        'path',
+        'ready',
+        'repo',
+        'short_name',
+        'url',
+    )
+
+    # How many SHA lookups to remember (e.g. for repeated snarfs).
+    COMMIT_CACHE_SIZE = 256
+
+    # How many formatted commits to remember.
+    FORMAT_CACHE_SIZE = 256
+
+    # Tags are never used, and branches deleted on the remote are dropped.
+    # (No --depth: log and snarfing need the history.)
+    FETCH_ARGS = ['--no-tags', '--prune']
+
     def __init__(self, repo_dir, long_name, options):
         """
         Initialize with a repository with the given name and dict of options
@@ -97,183 +401,391 @@ class Repository(object):
             raise Exception("Git-python API version uninitialized.")
 
         # Validate configuration ("channel" allowed for backward compatibility)
-        required_values = ['short name', 'url']
-        optional_values = ['branch', 'channel', 'channels', 'commit link',
-                           'commit message', 'commit reply']
-        for name in required_values:
-            if name not in options:
-                raise Exception('Section %s missing required value: %s' %
-                        (long_name, name))
-        for name, value in options.items():
-            if name not in required_values and name not in optional_values:
-                raise Exception('Section %s contains unrecognized value: %s' %
-                        (long_name, name))
+        required_values = set(['short name', 'url'])
+        optional_values = set(['branch', 'channel', 'channels', 'commit link',
+                               'commit message', 'commit reply'])
+        missing = required_values.difference(options)
+        if missing:
+            raise Exception('Section %s missing required value: %s' %
+                    (long_name, ', '.join(sorted(missing))))
+        unknown = set(options) - required_values - optional_values
+        if unknown:
+            raise Exception('Section %s contains unrecognized value: %s' %
+                    (long_name, ', '.join(sorted(unknown))))
 
         # Initialize
-        self.branch = 'origin/' + options.get('branch', 'master')
-        self.channels = options.get('channels', options.get('channel')).split()
+        if GIT_API_VERSION == 1:
+            self.get_commit_id = operator.attrgetter('id')
+        elif GIT_API_VERSION == 3:
+            self.get_commit_id = operator.attrgetter('hexsha')
+        else:
+            raise Exception("Unsupported API version: %d" % GIT_API_VERSION)
+        self.branch_display = options.get('branch', 'master')
+        self.branch = 'origin/' + self.branch_display
+        self.catfile = None
+        self.catfile_lock = threading.Lock()
+        self.channels = frozenset(
+            options.get('channels', options.get('channel')).split())
         self.commit_link = options.get('commit link', '')
+        self.link_program = compile_link(self.commit_link)
         self.commit_message = options.get('commit message', '[%s|%b|%a] %m')
         self.commit_reply = options.get('commit reply', '')
+        self.checked_generation = 0 # Generation get_new_commits last saw
+        self.commit_cache = LRUCache(Repository.COMMIT_CACHE_SIZE)
         self.errors = []
+        self.format_cache = LRUCache(Repository.FORMAT_CACHE_SIZE)
+        self.generation = 0 # Bumped whenever new commits may have arrived
         self.last_commit = None
-        self.lock = threading.RLock()
+        self.last_remote_heads = None
+        self.lock = RWLock()
         self.long_name = long_name
+        self.ready = False
         self.short_name = options['short name']
         self.repo = None
         self.url = options['url']
 
+        constants = {
+            'b': self.branch_display,
+            'n': self.long_name,
+            's': self.short_name,
+            'u': self.url,
+        }
+        self.message_program = compile_format(self.commit_message, constants)
+        self.reply_program = compile_format(self.commit_reply or
+                                            self.commit_message, constants)
+        self.message_keys = program_keys(self.message_program)
+        self.reply_keys = program_keys(self.reply_program)
+
         if not os.path.exists(repo_dir):
             os.makedirs(repo_dir)
         self.path = os.path.join(repo_dir, self.short_name)
 
-        # TODO: Move this to GitWatcher (separate thread)
-        self.clone()
+    # Network operations (clone, remote_changed, fetch) don't hold the lock
+    # while talking to the remote: git does its own locking of the files on
+    # disk, and readers simply see the refs from before or after.  Only the
+    # in-memory state they update afterwards is protected.
 
-    @synchronized('lock')
     def clone(self):
-        "If the repository doesn't exist on disk, clone it."
+        """
+        If the repository doesn't exist on disk, clone it.  Either way, open
+        it and mark the repository ready.  Until then, nothing can be read
+        from it.
+        """
         if not os.path.exists(self.path):
-            git.Git('.').clone(self.url, self.path, no_checkout=True)
-        self.repo = git.Repo(self.path)
-        self.last_commit = self.repo.commit(self.branch)
+            self._clone_bare()
+        self._open()
 
-    @synchronized('lock')
-    def fetch(self):
-        "Contact git repository and update last_commit appropriately."
-        self.repo.git.fetch()
+    def _open(self):
+        with self.lock.writer:
+            self.repo = git.Repo(self.path)
+            # Let git resolve the branch: older GitPython can't read the
+            # packed-refs file a clone by a newer git writes.
+            self.last_commit = self.repo.git.rev_parse(self.branch)
+            with self.catfile_lock:
+                self._start_catfile()
+            self.generation += 1
+            self.checked_generation = self.generation
+            self.ready = True
 
-    @synchronized('lock')
-    def get_commit(self, sha):
-        "Fetch the commit with the given SHA.  Returns None if not found."
+    def _clone_bare(self):
+        """
+        Make a bare clone without file contents or tags (only commits and
+        trees are ever needed), then set up the remote-tracking branches a
+        bare clone normally doesn't have, so self.branch resolves as usual.
+        This is all done in a temporary directory that only replaces
+        self.path once complete, so a failed clone is simply retried.
+        """
+        work_dir = tempfile.mkdtemp(prefix=self.short_name + '.',
+                                    dir=os.path.dirname(self.path))
         try:
-            return self.repo.commit(sha)
-        except ValueError: # 0.1.x
-            return None
-        except git.GitCommandError: # 0.3.x
-            return None
-        except git.BadObject: # 0.3.2
-            return None
-
-    @synchronized('lock')
-    def get_commit_id(self, commit):
-        if GIT_API_VERSION == 1:
-            return commit.id
-        elif GIT_API_VERSION == 3:
-            return commit.hexsha
-        else:
-            raise Exception("Unsupported API version: %d" % GIT_API_VERSION)
+            path = os.path.join(work_dir, 'clone')
+            try:
+                git.Git('.').clone(self.url, path, bare=True,
+                                   filter='blob:none', no_tags=True)
+            except git.GitCommandError, e:
+                # Partial clone needs git 2.19+.  (A server that doesn't
+                # support it just sends everything, which is fine.)
+                if 'unknown option' not in str(e) or 'filter' not in str(e):
+                    raise
+                shutil.rmtree(path, True)
+                git.Git('.').clone(self.url, path, bare=True)
+            repo = git.Repo(path)
+            repo.git.config('remote.origin.fetch',
+                            '+refs/heads/*:refs/remotes/origin/*')
+            repo.git.fetch(*Repository.FETCH_ARGS)
+            os.rename(path, self.path)
+        finally:
+            shutil.rmtree(work_dir, True)
 
-    @synchronized('lock')
-    def get_new_commits(self):
-        if GIT_API_VERSION == 1:
-            result = self.repo.commits_between(self.last_commit, self.branch)
-        elif GIT_API_VERSION == 3:
-            rev = "%s..%s" % (self.last_commit, self.branch)
-            # Workaround for GitPython bug:
-            # https://github.com/gitpython-developers/GitPython/issues/61
-            self.repo.odb.update_cache()
-            result = self.repo.iter_commits(rev)
-        else:
-            raise Exception("Unsupported API version: %d" % GIT_API_VERSION)
-        self.last_commit = self.repo.commit(self.branch)
-        return list(result)
+    def close(self):
+        "Release resources (external processes) held by this repository."
+        with self.catfile_lock:
+            self._stop_catfile()
 
-    @synchronized('lock')
-    def get_recent_commits(self, count):
-        if GIT_API_VERSION == 1:
-            return self.repo.commits(start=self.branch, max_count=count)
-        elif GIT_API_VERSION == 3:
-            return list(self.repo.iter_commits(self.branch))[:count]
+    def _start_catfile(self):
+        """
+        Start a long-running 'git cat-file --batch-check' so that checking
+        for a SHA doesn't cost a new process every time.  If it can't be
+        started, lookups go straight to git-python instead.  The caller holds
+        catfile_lock.
+        """
+        self._stop_catfile()
+        devnull = open(os.devnull, 'w')
+        # Name the repository explicitly, or git would look for one in the
+        # directories above if self.path isn't a repository.  In a partial
+        # clone, git would also go to the remote for any object it doesn't
+        # have, i.e. every full SHA that isn't a commit here, while the
+        # repository lock is held.
+        if GIT_API_VERSION == 3:
+            git_dir = self.repo.git_dir
         else:
-            raise Exception("Unsupported API version: %d" % GIT_API_VERSION)
+            git_dir = self.repo.path
+        env = dict(os.environ, GIT_DIR=git_dir, GIT_NO_LAZY_FETCH='1')
+        try:
+            self.catfile = subprocess.Popen(
+                ['git', 'cat-file', '--batch-check'], cwd=self.path, env=env,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+        except OSError, e:
+            log_warning('Unable to start git cat-file for %s: %s' %
+                        (self.short_name, str(e)))
+        finally:
+            devnull.close()
 
-    @synchronized('lock')
-    def format_link(self, commit):
-        "Return a link to view a given commit, based on config setting."
-        result = ''
-        escaped = False
-        for c in self.commit_link:
-            if escaped:
-                if c == 'c':
-                    result += self.get_commit_id(commit)[0:7]
-                elif c == 'C':
-                    result += self.get_commit_id(commit)
-                else:
-                    result += c
-                escaped = False
-            elif c == '%':
-                escaped = True
+    def _stop_catfile(self):
+        "Stop the cat-file process, if any.  The caller holds catfile_lock."
+        if self.catfile:
+            try:
+                self.catfile.stdin.close()
+                self.catfile.stdout.close()
+                self.catfile.wait()
+            except Exception, e:
+                log_warning('Stopping git cat-file for %s: %s' %
+                            (self.short_name, str(e)))
+            self.catfile = None
+
+    def _ask_catfile(self, sha):
+        """
+        Send one query to the cat-file process and return its reply, split
+        into words (empty if the process is gone).  The caller holds
+        catfile_lock.
+        """
+        if not self.catfile:
+            return []
+        try:
+            self.catfile.stdin.write(sha + '\n')
+            self.catfile.stdin.flush()
+            return self.catfile.stdout.readline().split()
+        except (IOError, OSError):
+            return []
+
+    def _batch_lookup(self, sha):
+        """
+        Ask the cat-file process about an abbreviated or full SHA.  Returns
+        the full SHA if it names a commit, '' if it doesn't, or None if the
+        process is unavailable.
+        """
+        with self.catfile_lock:
+            if not self.catfile:
+                return None
+            reply = self._ask_catfile(sha)
+            if not reply:
+                # Restart it once, and give up on it if that doesn't help.
+                log_warning('git cat-file for %s exited unexpectedly.' %
+                            self.short_name)
+                self._start_catfile()
+                reply = self._ask_catfile(sha)
+            if not reply:
+                log_warning('Not using git cat-file for %s any more.' %
+                            self.short_name)
+                self._stop_catfile()
+                return None
+        if len(reply) == 3 and reply[1] == 'commit':
+            return reply[0]
+        return '' # "missing", "ambiguous" or not a commit
+
+    def remote_changed(self, timeout):
+        """
+        Return whether any branch on the remote has moved since the last
+        check.  This only asks for the remote's ref advertisement, which is
+        much cheaper than a fetch when nothing has happened.  (Only the
+        fetcher thread uses last_remote_heads.)
+        """
+        heads = run_git(['ls-remote', '--heads', 'origin'], self.path,
+                        timeout)
+        changed = heads != self.last_remote_heads
+        self.last_remote_heads = heads
+        return changed
+
+    def fetch(self, timeout):
+        """
+        Contact git repository and update last_commit appropriately.  Gives
+        up (with an exception) after 'timeout' seconds.
+        """
+        run_git(['fetch', '--quiet'] + Repository.FETCH_ARGS, self.path,
+                timeout)
+        self._fetched()
+
+    def _fetched(self):
+        "Make newly fetched objects visible to readers."
+        with self.lock.writer:
+            if GIT_API_VERSION == 3:
+                # Workaround for GitPython bug (new packs otherwise go unseen):
+                # https://github.com/gitpython-developers/GitPython/issues/61
+                self.repo.odb.update_cache()
+            self.generation += 1
+
+    def get_commit(self, sha):
+        "Fetch the commit with the given SHA.  Returns None if not found."
+        with self.lock.reader:
+            if not self.ready:
+                return None
+            commit = self.commit_cache.get(sha)
+            if commit:
+                return commit
+            full_sha = self._batch_lookup(sha)
+            if full_sha == '':
+                return None
+            try:
+                commit = self.repo.commit(full_sha or sha)
+            except ValueError: # 0.1.x
+                return None
+            except git.GitCommandError: # 0.3.x
+                return None
+            except git.BadObject: # 0.3.2
+                return None
+            self.commit_cache.put(sha, commit)
+            return commit
+
+    def get_new_commits(self, max_count):
+        """
+        Return (count, commits): the number of commits since the last call,
+        and no more than max_count of the newest ones, oldest first.
+        """
+        with self.lock.writer:
+            if not self.ready:
+                return 0, []
+            # New commits only arrive by fetching, so if there hasn't been
+            # one since the last check, don't even start git.
+            if self.checked_generation == self.generation:
+                return 0, []
+            rev = "%s..%s" % (self.last_commit, self.branch)
+            # Only read the commits that can actually be displayed, plus one
+            # to tell whether there are more (and so the tip is always read,
+            # below).  Counting them all takes another git command, so only
+            # do it then.
+            result = self._log_commits(rev, max_count + 1)
+            if len(result) > max_count:
+                count = int(self.repo.git.rev_list('--count', rev))
             else:
-                result += c
+                count = len(result)
+            # The branch tip is one of the new commits, no need to look it up.
+            # With none, the branch may still have moved (rewound or forced
+            # back), and the old commit could eventually be pruned.
+            if result:
+                self.last_commit = result[-1].id
+            else:
+                self.last_commit = self.repo.git.rev_parse(self.branch)
+            self.checked_generation = self.generation
+            return count, result[len(result) - max_count:]
+
+    def _log_commits(self, rev, max_count):
+        """
+        Return the newest max_count commits of 'rev', oldest first, as
+        CommitInfo records.  A single 'git log' gives us everything formatting
+        needs, without GitPython building (and reading the objects for) a
+        full Commit for each one.
+        """
+        output = self.repo.git.log(rev, '-z', '--reverse',
+                                   max_count=max_count,
+                                   format='%H%x1f%an%x1f%ae%x1f%B')
+        if isinstance(output, str):
+            output = output.decode('utf-8', 'replace')
+        result = []
+        for entry in output.split('\0'):
+            if not entry:
+                continue
+            sha, name, email, message = entry.split('\x1f', 3)
+            result.append(CommitInfo(sha, sha, CommitAuthor(name, email),
+                                     message))
         return result
 
-    @synchronized('lock')
-    def format_message(self, commit, format_str=None):
+    def get_recent_commits(self, count):
+        "Return the last 'count' commits on the branch, oldest first."
+        with self.lock.reader:
+            if not self.ready:
+                return []
+            if GIT_API_VERSION == 1:
+                result = self.repo.commits(start=self.branch, max_count=count)
+                result.reverse() # Newest first from 0.1.x
+                return result
+            elif GIT_API_VERSION == 3:
+                return list(self.repo.iter_commits(self.branch,
+                                                   max_count=count,
+                                                   reverse=True))
+            else:
+                raise Exception("Unsupported API version: %d" %
+                                GIT_API_VERSION)
+
+    # The formatting methods only read configuration, which never changes
+    # after __init__, and commit objects, which are immutable, so they don't
+    # need the lock.
+
+    def format_link(self, commit_id, short_id=None):
+        "Return a link to view the given commit, based on config setting."
+        subst = {
+            'c': short_id or commit_id[0:7],
+            'C': commit_id,
+        }
+        return run_program(self.link_program, subst)
+
+    def format_message(self, commit, reply=False):
         """
         Generate an formatted message for IRC from the given commit, using
-        the format specified in the config. Returns a list of strings.
+        the format specified in the config (the commit reply format if
+        'reply' is set). Returns a list of strings.
         """
-        MODE_NORMAL = 0
-        MODE_SUBST = 1
-        MODE_COLOR = 2
+        commit_id = self.get_commit_id(commit)
+        # Commits never change, so neither does their formatting.
+        result = self.format_cache.get((commit_id, reply))
+        if result is not None:
+            return list(result)
+        if reply:
+            program, keys = self.reply_program, self.reply_keys
+        else:
+            program, keys = self.message_program, self.message_keys
+        # Only work out what the template actually uses.
+        short_id = commit_id[0:7]
         subst = {
-            'a': commit.author.name,
-            'b': self.branch[self.branch.rfind('/')+1:],
-            'c': self.get_commit_id(commit)[0:7],
-            'C': self.get_commit_id(commit),
-            'e': commit.author.email,
-            'l': self.format_link(commit),
-            'm': commit.message.split('\n')[0],
-            'n': self.long_name,
-            's': self.short_name,
-            'u': self.url,
-            'r': '\x0f',
-            '!': '\x02',
-            '%': '%',
+            'c': short_id,
+            'C': commit_id,
         }
+        if 'a' in keys:
+            subst['a'] = commit.author.name
+        if 'e' in keys:
+            subst['e'] = commit.author.email
+        if 'l' in keys:
+            subst['l'] = self.format_link(commit_id, short_id)
+        if 'm' in keys:
+            subst['m'] = commit.message.partition('\n')[0]
         result = []
-        if not format_str:
-            format_str = self.commit_message
-        lines = format_str.split('\n')
-        for line in lines:
-            mode = MODE_NORMAL
-            outline = ''
-            for c in line:
-                if mode == MODE_SUBST:
-                    if c in subst.keys():
-                        outline += subst[c]
-                        mode = MODE_NORMAL
-                    elif c == '(':
-                        color = ''
-                        mode = MODE_COLOR
-                    else:
-                        outline += c
-                        mode = MODE_NORMAL
-                elif mode == MODE_COLOR:
-                    if c == ')':
-                        outline += '\x03' + color
-                        mode = MODE_NORMAL
-                    else:
-                        color += c
-                elif c == '%':
-                    mode = MODE_SUBST
-                else:
-                    outline += c
-            result.append(outline.encode('utf-8'))
+        for ops in program:
+            result.append(run_program(ops, subst).encode('utf-8'))
+        self.format_cache.put((commit_id, reply), tuple(result))
         return result
 
-    @synchronized('lock')
     def record_error(self, e):
         "Save the exception 'e' for future error reporting."
-        self.errors.append(e)
+        with self.lock.writer:
+            self.errors.append(e)
+            # Whatever failed, make sure the next fetch isn't skipped.
+            self.last_remote_heads = None
 
-    @synchronized('lock')
     def get_errors(self):
         "Return a list of exceptions that have occurred since last get_errors."
-        result = self.errors
-        self.errors = []
-        return result
+        with self.lock.writer:
+            result = self.errors
+            self.errors = []
+            return result
 
 class Git(callbacks.PluginRegexp):
     "Please see the README file to configure and use this plugin."
@@ -281,13 +793,30 @@ class Git(callbacks.PluginRegexp):
     threaded = True
     unaddressedRegexps = [ '_snarf' ]
 
+    # How many hex strings per channel to remember as not being commits.
+    UNKNOWN_SHA_CACHE_SIZE = 1024
+
     def __init__(self, irc):
         self.init_git_python()
         self.__parent = super(Git, self)
         self.__parent.__init__(irc)
-        # Workaround the fact that self.log already exists in plugins
-        self.log = LogWrapper(self.log, Git._log.__get__(self))
+        self.config_sections = {}
+        self.coalesce_lines = False
+        self.config_stamp = None
         self.fetcher = None
+        self.max_commits_at_once = 0
+        self.registry_callbacks = []
+        self.repository_list = []
+        self.repositories_by_channel = {}
+        self.repositories_by_short_name = {}
+        self.sha_snarfing = False
+        self.unknown_shas = LRUCache(Git.UNKNOWN_SHA_CACHE_SIZE)
+        # Settings are read on rehash, or as soon as they change where the
+        # registry supports it (Limnoria).
+        self._watch_setting('pollPeriod', self._poll_period_changed)
+        self._watch_setting('coalesceLines', self._settings_changed)
+        self._watch_setting('maxCommitsAtOnce', self._settings_changed)
+        self._watch_setting('shaSnarfing', self._settings_changed)
         self._stop_polling()
         try:
             self._read_config()
@@ -297,7 +826,7 @@ class Git(callbacks.PluginRegexp):
             else:
                 # During bot startup, there is no one to reply to.
                 log_warning(str(e))
-        self._schedule_next_event()
+        self._start_polling()
 
     def init_git_python(self):
         global GIT_API_VERSION, git
@@ -313,8 +842,48 @@ class Git(callbacks.PluginRegexp):
                     % git.__version__)
             GIT_API_VERSION = 3
 
+    # Plugins already have a 'log' attribute (their logger), so the log
+    # command is implemented by _log and dispatched by name here.  The logger
+    # is left out of dir(), which Supybot scans for commands.
+
+    def __dir__(self):
+        names = set(dir(self.__class__)) | set(self.__dict__)
+        names.discard('log')
+        return sorted(names)
+
+    def isCommandMethod(self, name):
+        if name == 'log':
+            return not self.isDisabled(name)
+        return self.__parent.isCommandMethod(name)
+
+    def getCommandMethod(self, command):
+        if command == ['log']:
+            return self._log
+        return self.__parent.getCommandMethod(command)
+
+    # Also overridden to hide the obsolete commands
+    def listCommands(self, pluginCommands=[]):
+        if self.isCommandMethod('log'):
+            pluginCommands = pluginCommands + ['log']
+        commands = self.__parent.listCommands(pluginCommands)
+        return [command for command in commands
+                if command not in ('gitrehash', 'repolist', 'shortlog')]
+
+    def doPrivmsg(self, irc, msg):
+        # Snarfing is the only thing done here, so don't even run the regexp
+        # when it's disabled, or on messages to channels with no repositories.
+        if self.sha_snarfing and msg.args[0] in self.repositories_by_channel:
+            self.__parent.doPrivmsg(irc, msg)
+
     def die(self):
+        for value, callback in self.registry_callbacks:
+            try:
+                value.removeCallback(callback)
+            except Exception, e:
+                log_warning('Removing registry callback: %s' % str(e))
         self._stop_polling()
+        for repository in self.repository_list:
+            repository.close()
         self.__parent.die()
 
     def _log(self, irc, msg, args, channel, name, count):
@@ -323,17 +892,20 @@ class Git(callbacks.PluginRegexp):
         Display the last commits on the named repository. [count] defaults to
         1 if unspecified.
         """
-        matches = filter(lambda r: r.short_name == name, self.repository_list)
-        if not matches:
+        repository = self.repositories_by_short_name.get(name)
+        if not repository:
             irc.reply('No configured repository named %s.' % name)
             return
         # Enforce a modest privacy measure... don't let people probe the
         # repository outside the designated channel.
-        repository = matches[0]
         if channel not in repository.channels:
             irc.reply('Sorry, not allowed in this channel.')
             return
-        commits = repository.get_recent_commits(count)[::-1]
+        if not repository.ready:
+            irc.reply('%s is not ready yet, please try again later.' %
+                      repository.long_name)
+            return
+        commits = repository.get_recent_commits(count)
         self._reply_commits(irc, channel, repository, commits)
     _log = wrap(_log, ['channel', 'somethingWithoutSpaces',
                        optional('positiveInt', 1)])
@@ -346,27 +918,29 @@ class Git(callbacks.PluginRegexp):
         self._stop_polling()
         try:
             self._read_config()
-            self._schedule_next_event()
             n = len(self.repository_list)
             irc.reply('Git reinitialized with %d %s.' %
                       (n, plural(n, 'repository')))
         except Exception, e:
             irc.reply('Warning: %s' % str(e))
+        finally:
+            # A bad config file leaves the previous repositories in place,
+            # and they still need polling.
+            self._start_polling()
 
     def repositories(self, irc, msg, args, channel):
         """(takes no arguments)
 
         Display the names of known repositories configured for this channel.
         """
-        repositories = filter(lambda r: channel in r.channels,
-                              self.repository_list)
+        repositories = self.repositories_by_channel.get(channel)
         if not repositories:
             irc.reply('No repositories configured for this channel.')
             return
         for r in repositories:
             fmt = '\x02%(short_name)s\x02 (%(name)s, branch: %(branch)s)'
             irc.reply(fmt % {
-                'branch': r.branch.split('/')[-1],
+                'branch': r.branch_display,
                 'name': r.long_name,
                 'short_name': r.short_name,
                 'url': r.url,
@@ -385,117 +959,197 @@ class Git(callbacks.PluginRegexp):
         "Obsolete command, remove this function eventually."
         irc.reply('"shortlog" is obsolete, please use "log".')
 
-    # Overridden to hide the obsolete commands
-    def listCommands(self, pluginCommands=[]):
-        return ['log', 'rehash', 'repositories']
-
-    def _display_commits(self, irc, channel, repository, commits):
-        "Display a nicely-formatted list of commits in a channel."
-        commits = list(commits)
-        commits_at_once = self.registryValue('maxCommitsAtOnce')
-        if len(commits) > commits_at_once:
-            irc.queueMsg(ircmsgs.privmsg(channel,
-                         "Showing latest %d of %d commits to %s..." %
-                         (commits_at_once, len(commits), repository.long_name)))
-        for commit in commits[-commits_at_once:]:
-            lines = repository.format_message(commit)
-            for line in lines:
-                msg = ircmsgs.privmsg(channel, line)
-                irc.queueMsg(msg)
+    def _format_commits(self, repository, count, commits):
+        """
+        Return the lines announcing a nicely-formatted list of commits (oldest
+        first) out of a total of 'count' new commits.
+        """
+        commits_at_once = self.max_commits_at_once
+        lines = []
+        if count > commits_at_once:
+            lines.append("Showing latest %d of %d commits to %s..." %
+                         (commits_at_once, count, repository.long_name))
+        for commit in commits:
+            lines.extend(repository.format_message(commit))
+        return lines
 
     # Post commits to channel as a reply
     def _reply_commits(self, irc, channel, repository, commits):
         commits = list(commits)
-        commits_at_once = self.registryValue('maxCommitsAtOnce')
+        commits_at_once = self.max_commits_at_once
         if len(commits) > commits_at_once:
             irc.reply("Showing latest %d of %d commits to %s..." %
                       (commits_at_once, len(commits), repository.long_name))
-        format_str = repository.commit_reply or repository.commit_message
         for commit in commits[-commits_at_once:]:
-            lines = repository.format_message(commit, format_str)
+            lines = repository.format_message(commit, reply=True)
             map(irc.reply, lines)
 
-    def _poll(self):
-        # Note that polling happens in two steps:
+    def _poll(self, batch):
+        # Note that polling happens in two steps, both in GitFetcher's thread:
         #
-        # 1. The GitFetcher class, running its own poll loop, fetches
-        #    repositories to keep the local copies up to date.
-        # 2. This _poll occurs, and looks for new commits in those local
-        #    copies.  (Therefore this function should be quick. If it is
-        #    slow, it may block the entire bot.)
+        # 1. GitFetcher fetches a batch of repositories to keep the local
+        #    copies up to date.
+        # 2. It then calls this _poll, which looks for new commits in those
+        #    local copies and announces them.
         try:
-            for repository in self.repository_list:
-                # Find the IRC/channel pairs to notify
-                targets = []
-                for irc in world.ircs:
-                    for channel in repository.channels:
-                        if channel in irc.state.channels:
-                            targets.append((irc, channel))
+            # Which networks are on which channels, gathered once per poll
+            ircs_by_channel = collections.defaultdict(list)
+            for irc in world.ircs:
+                for channel in irc.state.channels:
+                    ircs_by_channel[channel].append(irc)
+            for repository in batch:
+                # Find the channels to notify, and the networks they're on
+                targets = [(channel, ircs_by_channel[channel])
+                           for channel in repository.channels
+                           if channel in ircs_by_channel]
                 if not targets:
                     log_info("Skipping %s: not in configured channel(s)." %
                              repository.long_name)
                     continue
 
                 # Manual non-blocking lock calls here to avoid potentially long
-                # waits (if it fails, hope for better luck in the next _poll).
-                if repository.lock.acquire(blocking=False):
-                    try:
-                        errors = repository.get_errors()
-                        for e in errors:
-                            log_error('Unable to fetch %s: %s' %
-                                (repository.long_name, str(e)))
-                        commits = repository.get_new_commits()[::-1]
-                        for irc, channel in targets:
-                            self._display_commits(irc, channel, repository,
-                                                  commits)
-                    except Exception, e:
-                        log_error('Exception in _poll repository %s: %s' %
-                                (repository.short_name, str(e)))
-                    finally:
-                        repository.lock.release()
-                else:
+                # waits (if it fails, hope for better luck in the next poll).
+                if not repository.lock.acquire_write(blocking=False):
                     log.info('Postponing repository read: %s: Locked.' %
                         repository.long_name)
-            self._schedule_next_event()
+                    continue
+                errors = []
+                try:
+                    errors = repository.get_errors()
+                    count, commits = repository.get_new_commits(
+                        self.max_commits_at_once)
+                except Exception, e:
+                    log_error('Exception in _poll repository %s: %s' %
+                            (repository.short_name, str(e)))
+                    continue
+                finally:
+                    repository.lock.release_write()
+                    # get_errors cleared them, so report them even if
+                    # reading the new commits failed.
+                    for e in errors:
+                        log_error('Unable to fetch %s: %s' %
+                            (repository.long_name, str(e)))
+
+                # Everything else happens outside the lock.
+                try:
+                    lines = self._format_commits(repository, count, commits)
+                    if self.coalesce_lines:
+                        lines = coalesce_lines(lines)
+                except Exception, e:
+                    log_error('Exception in _poll repository %s: %s' %
+                            (repository.short_name, str(e)))
+                    continue
+                # IrcMsg objects are immutable, so one set of messages per
+                # channel serves every network it's on.
+                for channel, ircs in targets:
+                    msgs = [ircmsgs.privmsg(channel, line) for line in lines]
+                    for irc in ircs:
+                        for msg in msgs:
+                            irc.queueMsg(msg)
         except Exception, e:
             log_error('Exception in _poll(): %s' % str(e))
-            traceback.print_exc(e)
+            traceback.print_exc()
+
+    def _watch_setting(self, name, callback):
+        value = conf.supybot.plugins.Git.get(name)
+        if hasattr(value, 'addCallback') and hasattr(value, 'removeCallback'):
+            value.addCallback(callback)
+            self.registry_callbacks.append((value, callback))
+
+    def _read_settings(self):
+        "Read the settings used for every message and commit shown."
+        self.coalesce_lines = self.registryValue('coalesceLines')
+        self.max_commits_at_once = self.registryValue('maxCommitsAtOnce')
+        self.sha_snarfing = self.registryValue('shaSnarfing')
+
+    def _settings_changed(self, *args, **kwargs):
+        self._read_settings()
 
     def _read_config(self):
-        self.repository_list = []
+        self._read_settings()
         repo_dir = self.registryValue('repoDir')
         config = self.registryValue('configFile')
         if not os.access(config, os.R_OK):
             raise Exception('Cannot access configuration file: %s' % config)
+        # Only reread the file if it (or where it points) has changed.
+        stamp = (config, os.path.getmtime(config), repo_dir)
+        if stamp != self.config_stamp:
+            self._load_repositories(config, repo_dir)
+            self.config_stamp = stamp
+        # Normally GitFetcher clones repositories in the background, but it
+        # doesn't run when polling is disabled.
+        if self.registryValue('pollPeriod') == 0:
+            for repository in self.repository_list:
+                if not repository.ready:
+                    repository.clone()
+
+    def _load_repositories(self, config, repo_dir):
+        """
+        Set up the repositories defined in the given config file.  Sections
+        that haven't changed keep their existing Repository (and its open
+        git.Repo).  If the file has an error, nothing changes.
+        """
         parser = ConfigParser.RawConfigParser()
         parser.read(config)
-        for section in parser.sections():
-            options = dict(parser.items(section))
-            self.repository_list.append(Repository(repo_dir, section, options))
+        old_repositories = dict((r.long_name, r) for r in self.repository_list)
+        sections = {}
+        repository_list = []
+        try:
+            for section in parser.sections():
+                sections[section] = (repo_dir, dict(parser.items(section)))
+                if sections[section] == self.config_sections.get(section):
+                    repository = old_repositories.pop(section)
+                else:
+                    repository = Repository(repo_dir, section,
+                                            sections[section][1])
+                repository_list.append(repository)
+        except:
+            for repository in repository_list:
+                if repository not in self.repository_list:
+                    repository.close()
+            raise
+        for repository in old_repositories.values():
+            repository.close()
+        self.config_sections = sections
+        self.repository_list = repository_list
+        self.repositories_by_channel = collections.defaultdict(list)
+        self.repositories_by_short_name = {}
+        for repository in repository_list:
+            for channel in repository.channels:
+                self.repositories_by_channel[channel].append(repository)
+            self.repositories_by_short_name.setdefault(repository.short_name,
+                                                       repository)
+        self.unknown_shas.clear()
 
-    def _schedule_next_event(self):
+    def _start_polling(self):
+        # The poll settings hold from here on, until polling is restarted.
         period = self.registryValue('pollPeriod')
         if period > 0:
-            if not self.fetcher or not self.fetcher.isAlive():
-                self.fetcher = GitFetcher(self.repository_list, period)
-                self.fetcher.start()
-            schedule.addEvent(self._poll, time.time() + period,
-                              name=self.name())
-        else:
-            self._stop_polling()
+            self.fetcher = GitFetcher(self.repository_list, period,
+                self.registryValue('pollBatchDivisor'), self._poll)
+            self.fetcher.start()
+
+    def _poll_period_changed(self, *args, **kwargs):
+        self._stop_polling()
+        self._start_polling()
 
     def _snarf(self, irc, msg, match):
         r"""\b(?P<sha>[0-9a-f]{6,40})\b"""
-        if self.registryValue('shaSnarfing'):
-            sha = match.group('sha')
-            channel = msg.args[0]
-            repositories = filter(lambda r: channel in r.channels,
-                                  self.repository_list)
-            for repository in repositories:
-                commit = repository.get_commit(sha)
-                if commit:
-                    self._reply_commits(irc, channel, repository, [commit])
-                    break
+        sha = match.group('sha')
+        channel = msg.args[0]
+        repositories = self.repositories_by_channel.get(channel, [])
+        # Hex strings that aren't commits (colors, hashes in URLs...) tend
+        # to repeat.  A miss is only trusted until a repository fetches.
+        generations = [r.generation for r in repositories]
+        if self.unknown_shas.get((channel, sha)) == generations:
+            return
+        for repository in repositories:
+            commit = repository.get_commit(sha)
+            if commit:
+                self._reply_commits(irc, channel, repository, [commit])
+                break
+        else:
+            self.unknown_shas.put((channel, sha), generations)
 
     def _stop_polling(self):
         # Never allow an exception to propagate since this is called in die()
@@ -506,106 +1160,110 @@ class Git(callbacks.PluginRegexp):
             except Exception, e:
                 log_error('Stopping fetcher: %s' % str(e))
             self.fetcher = None
-        try:
-            schedule.removeEvent(self.name())
-        except KeyError:
-            pass
-        except Exception, e:
-            log_error('Stopping scheduled task: %s' % str(e))
 
 class GitFetcher(threading.Thread):
-    "A thread object to perform long-running Git operations."
+    """
+    A thread object to perform long-running Git operations: the initial clone
+    of each repository, then periodic fetches.
+    """
 
-    # I don't know of any way to shut down a thread except to have it
-    # check a variable very frequently.
-    SHUTDOWN_CHECK_PERIOD = 0.1 # Seconds
+    # Fetches are network-bound, so several can overlap usefully, but don't
+    # open an unbounded number of connections at once.
+    MAX_WORKERS = 8
 
-    # TODO: Wrap git fetch command and enforce a timeout.  Git will probably
-    # timeout on its own in most cases, but I have actually seen it hang
-    # forever on "fetch" before.
+    # Git will probably time out on its own in most cases, but it has been
+    # seen to hang forever on "fetch".  Give up on a fetch (and report it as
+    # an error) once it has taken a whole period, but allow at least this
+    # long (in seconds) for it.
+    MIN_FETCH_TIMEOUT = 60
 
-    def __init__(self, repositories, period, *args, **kwargs):
+    def __init__(self, repositories, period, divisor=1, callback=None,
+                 *args, **kwargs):
         """
         Takes a list of repositories and a period (in seconds) to poll them.
         As long as it is running, the repositories will be kept up to date
-        every period seconds (with a git fetch).
+        every period seconds (with a git fetch), or every 'divisor' periods
+        if they are to be fetched in rotating batches.  After each batch,
+        callback (if given) is called with the list of repositories in it.
         """
         super(GitFetcher, self).__init__(*args, **kwargs)
+        self.callback = callback
+        self.cursor = 0
+        self.divisor = divisor
         self.repository_list = repositories
-        self.period = period * 1.1 # Hacky attempt to avoid resonance
-        self.shutdown = False
+        self.period = period
+        self.shutdown = threading.Event()
 
     def stop(self):
         """
         Shut down the thread as soon as possible. May take some time if
         inside a long-running fetch operation.
         """
-        self.shutdown = True
+        self.shutdown.set()
 
     def run(self):
         "The main thread method."
-        # Initially wait for half the period to stagger this thread and
-        # the main thread and avoid lock contention.
-        end_time = time.time() + self.period/2
-        while not self.shutdown:
+        while not self.shutdown.isSet():
+            end_time = time.time() + self.period
             try:
-                for repository in self.repository_list:
-                    if self.shutdown: break
-                    if repository.lock.acquire(blocking=False):
-                        try:
-                            repository.fetch()
-                        except Exception, e:
-                            repository.record_error(e)
-                        finally:
-                            repository.lock.release()
-                    else:
-                        log_info('Postponing repository fetch: %s: Locked.' %
-                                 repository.long_name)
+                batch = self._fetch_all()
+                if self.callback and not self.shutdown.isSet():
+                    self.callback(batch)
+            except Exception, e:
+                log_error('Exception fetching repositories: %s' % str(e))
+            # Wait for the next periodic check (or until stopped)
+            self.shutdown.wait(max(0, end_time - time.time()))
+
+    def _fetch_all(self):
+        """
+        Fetch the next batch of repositories, several at a time, and return
+        the batch when all of them are done (or once in-progress fetches
+        finish after a shutdown).  Repositories not cloned yet are always
+        included.
+        """
+        batch, self.cursor = next_batch(self.repository_list, self.cursor,
+                                        self.divisor)
+        batch += [r for r in self.repository_list
+                  if not r.ready and r not in batch]
+        queue = Queue.Queue()
+        for repository in batch:
+            queue.put(repository)
+        n = min(GitFetcher.MAX_WORKERS, len(batch))
+        workers = [threading.Thread(target=self._fetch_worker, args=(queue,))
+                   for i in range(n)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return batch
+
+    def _fetch_worker(self, queue):
+        "Fetch repositories from the queue until it is empty."
+        while not self.shutdown.isSet():
+            try:
+                repository = queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                self._fetch(repository)
             except Exception, e:
                 log_error('Exception checking repository %s: %s' %
                           (repository.short_name, str(e)))
-            # Wait for the next periodic check
-            while not self.shutdown and time.time() < end_time:
-                time.sleep(GitFetcher.SHUTDOWN_CHECK_PERIOD)
-            end_time = time.time() + self.period
-
-class LogWrapper(object):
-    """
-    Horrific workaround for the fact that PluginMixin has a member variable
-    called 'log' -- wiping out my 'log' command.  Delegates all requests to
-    the log, and when called as a function, performs the log command.
-    """
 
-    LOGGER_METHODS = [
-        'debug',
-        'info',
-        'warning',
-        'error',
-        'critical',
-        'exception',
-    ]
-
-    def __init__(self, log_object, log_command):
-        "Construct the wrapper with the objects being wrapped."
-        self.log_object = log_object
-        self.log_command = log_command
-        self.__doc__ = log_command.__doc__
-
-    def __call__(self, *args, **kwargs):
-        return self.log_command(*args, **kwargs)
-
-    def __getattr__(self, name):
-        if name in LogWrapper.LOGGER_METHODS:
-            return getattr(self.log_object, name)
-        else:
-            return getattr(self.log_command, name)
-
-# Because isCommandMethod() relies on inspection (whyyyy), I do this (gross)
-import inspect
-if 'git_orig_ismethod' not in dir(inspect):
-    inspect.git_orig_ismethod = inspect.ismethod
-    inspect.ismethod = \
-        lambda x: type(x) == LogWrapper or inspect.git_orig_ismethod(x)
+    def _fetch(self, repository):
+        """
+        Clone or fetch one repository, recording any error for _poll to
+        report.  The repository takes its lock only briefly, after the
+        network operation, so this doesn't hold up readers.
+        """
+        try:
+            timeout = max(self.period, GitFetcher.MIN_FETCH_TIMEOUT)
+            if not repository.ready:
+                repository.clone()
+            elif repository.remote_changed(timeout):
+                repository.fetch(timeout)
+        except Exception, e:
+            repository.record_error(e)
 
 Class = Git
 
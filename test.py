@@ -22,38 +22,64 @@ from supybot.test import *
 from supybot import conf
 
 from mock import Mock, patch
+import atexit
+import collections
 import git
 import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
 import time
 
+from . import plugin
+
 SRC_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(SRC_DIR, 'test-data')
+EMPTY_INI = os.path.join(DATA_DIR, 'empty.ini')
+MULTI_CHANNEL_INI = os.path.join(DATA_DIR, 'multi-channel.ini')
+ONE_INI = os.path.join(DATA_DIR, 'one.ini')
 
 # This timeout value works for me and keeps the tests snappy. If test queries
 # are not getting responses, you may need to bump this higher.
 LOOP_TIMEOUT = 0.1
 
-# Global mocks
-git.Git.clone = Mock()
+# Keep the "clones" out of wherever the tests are run from.
+REPO_DIR = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, REPO_DIR, True)
+conf.supybot.plugins.Git.repoDir.setValue(REPO_DIR)
+
+# Global mocks (a "clone" is just the directory it would create).  Their
+# git_dir isn't a repository, so git cat-file exits at once and SHA lookups
+# go to the mock.  The tests against real repositories put the real ones back.
+REAL_REPO = git.Repo
+git.Git.clone = Mock(side_effect=lambda url, path, **kwargs: os.makedirs(path))
 git.Repo = Mock()
+git.Repo.return_value.git_dir = REPO_DIR
+
+# Plain stand-ins for GitPython commits (the plugin only reads attributes)
+Author = collections.namedtuple('Author', 'name email')
+Commit = collections.namedtuple('Commit', 'author hexsha message')
 
 # A pile of commits for use wherever (most recent first)
-COMMITS = [Mock(), Mock(), Mock(), Mock(), Mock()]
-COMMITS[0].author.name = 'nstark'
-COMMITS[0].hexsha = 'abcdefabcdefabcdefabcdefabcdefabcdefabcd'
-COMMITS[0].message = 'Fix bugs.'
-COMMITS[1].author.name = 'tlannister'
-COMMITS[1].hexsha = 'abcdefabcdefabcdefabcdefabcdefabcdefabcd'
-COMMITS[1].message = 'I am more long-winded\nand may even use newlines.'
-COMMITS[2].author.name = 'tlannister'
-COMMITS[2].hexsha = 'abcdefabcdefabcdefabcdefabcdefabcdefabcd'
-COMMITS[2].message = 'Snarks and grumpkins'
-COMMITS[3].author.name = 'jsnow'
-COMMITS[3].hexsha = 'abcdefabcdefabcdefabcdefabcdefabcdefabcd'
-COMMITS[3].message = "Finished brooding, think I'll go brood."
-COMMITS[4].author.name = 'tlannister'
-COMMITS[4].hexsha = 'deadbeefcdefabcdefabcdefabcdefabcdefabcd'
-COMMITS[4].message = "I'm the only one getting things done."
+COMMITS = [
+    Commit(Author('nstark', 'nstark@example.com'),
+           'abcdefabcdefabcdefabcdefabcdefabcdefabcd',
+           'Fix bugs.'),
+    Commit(Author('tlannister', 'tlannister@example.com'),
+           'bcdefabcdefabcdefabcdefabcdefabcdefabcda',
+           'I am more long-winded\nand may even use newlines.'),
+    Commit(Author('tlannister', 'tlannister@example.com'),
+           'cdefabcdefabcdefabcdefabcdefabcdefabcdab',
+           'Snarks and grumpkins'),
+    Commit(Author('jsnow', 'jsnow@example.com'),
+           'defabcdefabcdefabcdefabcdefabcdefabcdabc',
+           "Finished brooding, think I'll go brood."),
+    Commit(Author('tlannister', 'tlannister@example.com'),
+           'deadbeefcdefabcdefabcdefabcdefabcdefabcd',
+           "I'm the only one getting things done."),
+]
 
 # Workaround Supybot 0.83.4.1 bug with Owner treating 'log' as a command
 conf.registerGlobalValue(conf.supybot.commands.defaultPlugins,
@@ -64,60 +90,192 @@ conf.supybot.commands.defaultPlugins.get('log').set('Git')
 GIT_API_VERSION = int(git.__version__[2])
 assert GIT_API_VERSION == 3, 'Tests only run against GitPython 0.3.x+ API.'
 
+# Reply to a log command with invalid arguments
+LOG_USAGE = ('(\x02log <short name> [count]\x02) -- Display the last commits '
+             'on the named repository. [count] defaults to 1 if unspecified.')
+
 class PluginTestCaseUtilMixin(object):
-    "Some additional utilities used in this plugin's tests."
+    "Some additional utilities used in this plugin's channel tests."
 
     def _feedMsgLoop(self, query, timeout=None, **kwargs):
         "Send a message and wait for a list of responses instead of just one."
         if timeout is None:
             timeout = LOOP_TIMEOUT
         responses = []
-        start = time.time()
+        deadline = time.time() + timeout
         r = self._feedMsg(query, timeout=timeout, **kwargs)
-        # Sleep off remaining time, then start sending empty queries until
-        # the replies stop coming.
-        remainder = timeout - (time.time() - start)
-        time.sleep(remainder if remainder > 0 else 0)
-        query = conf.supybot.reply.whenAddressedBy.chars()[0]
-        while r:
-            responses.append(r)
-            r = self._feedMsg(query, timeout=0, **kwargs)
+        # Once the first reply is in, collect the queued ones until they stop
+        # coming (a couple of misses in a row), rather than sleeping off the
+        # rest of the timeout.
+        misses = 0
+        while r or (responses and misses < 2 and time.time() < deadline):
+            if r:
+                responses.append(r)
+                misses = 0
+            else:
+                misses += 1
+                time.sleep(0.001)
+            r = self._takeMsg()
         return responses
 
+    def _takeMsg(self):
+        """
+        Take the next queued reply without feeding another query, stripping
+        the nick prefix like ChannelPluginTestCase._feedMsg does.
+        """
+        msg = self.irc.takeMsg()
+        if msg is not None and msg.command == 'PRIVMSG':
+            args = list(msg.args)
+            if args[1].startswith(self.nick) or \
+               args[1].startswith(ircutils.nickFromHostmask(self.prefix)):
+                args[1] = args[1].split(' ', 1)[-1]
+                msg = ircmsgs.privmsg(*args)
+        return msg
+
+    def assertRepositoriesLoaded(self, count):
+        """
+        Check that the plugin loaded its configuration (it only logs errors
+        while loading, where rehash would report them).
+        """
+        cb = self.irc.getCallback('Git')
+        self.assertEqual(len(cb.repository_list), count)
+
     def assertResponses(self, query, expectedResponses, **kwargs):
         "Run a command and assert that it returns the given list of replies."
         responses = self._feedMsgLoop(query, **kwargs)
-        responses = map(lambda m: m.args[1], responses)
-        self.assertEqual(responses, expectedResponses,
-                         '\nActual:\n%s\n\nExpected:\n%s' %
-                         ('\n'.join(responses), '\n'.join(expectedResponses)))
+        responses = [m.args[1] for m in responses]
+        # Only build the report when it's needed.
+        if responses != expectedResponses:
+            self.fail('\nActual:\n%s\n\nExpected:\n%s' %
+                      ('\n'.join(responses), '\n'.join(expectedResponses)))
         return responses
 
 class GitRehashTest(PluginTestCase):
     plugins = ('Git',)
 
-    def setUp(self):
-        super(GitRehashTest, self).setUp()
+    @classmethod
+    def setUpClass(cls):
+        super(GitRehashTest, cls).setUpClass()
         conf.supybot.plugins.Git.pollPeriod.setValue(0)
 
     def testRehashEmpty(self):
-        conf.supybot.plugins.Git.configFile.setValue(DATA_DIR + '/empty.ini')
+        conf.supybot.plugins.Git.configFile.setValue(EMPTY_INI)
         self.assertResponse('rehash', 'Git reinitialized with 0 repositories.')
 
     def testRehashOne(self):
-        conf.supybot.plugins.Git.configFile.setValue(DATA_DIR + '/one.ini')
+        conf.supybot.plugins.Git.configFile.setValue(ONE_INI)
         self.assertResponse('rehash', 'Git reinitialized with 1 repository.')
 
+    def testRehashMulti(self):
+        conf.supybot.plugins.Git.configFile.setValue(MULTI_CHANNEL_INI)
+        self.assertResponse('rehash', 'Git reinitialized with 3 repositories.')
+
+    def testListCommands(self):
+        self.assertResponse('list Git', 'log, rehash, and repositories')
+
+# Sections for the INI files written by GitReloadTest
+REPO_ONE = """[Repo One]
+short name = one
+url = https://example.com/one.git
+channels = #test
+"""
+REPO_TWO = """[Repo Two]
+short name = two
+url = https://example.com/two.git
+channels = #test
+"""
+REPO_TWO_CHANGED = REPO_TWO + "branch = feature\n"
+REPO_THREE = """[Repo Three]
+short name = three
+url = https://example.com/three.git
+channels = #test
+"""
+REPO_BAD = """[Repo Bad]
+short name = bad
+channels = #test
+"""
+
+class GitReloadTest(PluginTestCase):
+    plugins = ('Git',)
+
+    def setUp(self):
+        super(GitReloadTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.repo_dir = conf.supybot.plugins.Git.repoDir()
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.repoDir.setValue(
+            os.path.join(self.dir, 'repositories'))
+
+    def tearDown(self):
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.repoDir.setValue(self.repo_dir)
+        # Stop the plugin (and any polling) before removing its files.
+        super(GitReloadTest, self).tearDown()
+        shutil.rmtree(self.dir, True)
+
+    def _rehash(self, name, sections, expected):
+        "Write an INI file from the given sections, and rehash with it."
+        ini = os.path.join(self.dir, name)
+        with open(ini, 'w') as f:
+            f.write('\n'.join(sections))
+        conf.supybot.plugins.Git.configFile.setValue(ini)
+        self.assertResponse('rehash', expected)
+        return list(self.irc.getCallback('Git').repository_list)
+
+    def testRehashChanges(self):
+        closed = []
+        close = plugin.Repository.close
+        def record_close(repository):
+            closed.append(repository)
+            close(repository)
+        with patch.object(plugin.Repository, 'close', record_close):
+            one, two = self._rehash('first.ini', [REPO_ONE, REPO_TWO],
+                                    'Git reinitialized with 2 repositories.')
+            # Unchanged sections keep their Repository, changed ones don't.
+            repositories = self._rehash('changed.ini',
+                [REPO_ONE, REPO_TWO_CHANGED],
+                'Git reinitialized with 2 repositories.')
+            self.failUnless(repositories[0] is one)
+            self.failIf(repositories[1] is two)
+            self.assertEqual(repositories[1].branch_display, 'feature')
+            self.failUnless(two in closed)
+            self.failIf(one in closed)
+            # An invalid file changes nothing, but what was made for it is
+            # closed again.
+            del closed[:]
+            after_error = self._rehash('invalid.ini',
+                [REPO_ONE, REPO_TWO_CHANGED, REPO_THREE, REPO_BAD],
+                'Warning: Section Repo Bad missing required value: url')
+            self.assertEqual(map(id, after_error), map(id, repositories))
+            self.assertEqual([r.long_name for r in closed], ['Repo Three'])
+
+    def testRehashInvalidKeepsPolling(self):
+        conf.supybot.plugins.Git.pollPeriod.setValue(1000)
+        self._rehash('first.ini', [REPO_ONE, REPO_TWO],
+                     'Git reinitialized with 2 repositories.')
+        repositories = self._rehash('invalid.ini', [REPO_ONE, REPO_BAD],
+            'Warning: Section Repo Bad missing required value: url')
+        # The old repositories are still there, and still polled.
+        self.assertEqual(len(repositories), 2)
+        fetcher = self.irc.getCallback('Git').fetcher
+        self.failUnless(fetcher and fetcher.is_alive())
+        self.assertEqual(fetcher.repository_list, repositories)
+
 class GitRepositoryListTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#test'
     plugins = ('Git',)
 
+    @classmethod
+    def setUpClass(cls):
+        # The plugin reads this configuration as it's loaded for each test,
+        # so there's no need to rehash in setUp.
+        super(GitRepositoryListTest, cls).setUpClass()
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.configFile.setValue(MULTI_CHANNEL_INI)
+
     def setUp(self):
         super(GitRepositoryListTest, self).setUp()
-        ini = os.path.join(DATA_DIR, 'multi-channel.ini')
-        conf.supybot.plugins.Git.pollPeriod.setValue(0)
-        conf.supybot.plugins.Git.configFile.setValue(ini)
-        self.assertResponse('rehash', 'Git reinitialized with 3 repositories.')
+        self.assertRepositoriesLoaded(3)
 
     def testRepositoryList(self):
         expected = [
@@ -130,11 +288,17 @@ class GitNoAccessTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#unused'
     plugins = ('Git',)
 
+    @classmethod
+    def setUpClass(cls):
+        # The plugin reads this configuration as it's loaded for each test,
+        # so there's no need to rehash in setUp.
+        super(GitNoAccessTest, cls).setUpClass()
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.configFile.setValue(MULTI_CHANNEL_INI)
+
     def setUp(self):
         super(GitNoAccessTest, self).setUp()
-        ini = os.path.join(DATA_DIR, 'multi-channel.ini')
-        conf.supybot.plugins.Git.configFile.setValue(ini)
-        self.assertResponse('rehash', 'Git reinitialized with 3 repositories.')
+        self.assertRepositoriesLoaded(3)
 
     def testRepositoryListNoAccess(self):
         expected = ['No repositories configured for this channel.']
@@ -148,21 +312,35 @@ class GitLogTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
     channel = '#somewhere'
     plugins = ('Git',)
 
-    def setUp(self):
-        super(GitLogTest, self).setUp()
-        self._metamock = patch('git.Repo')
-        self.Repo = self._metamock.__enter__()
-        self.Repo.return_value = self.Repo
-        self.Repo.iter_commits.return_value = COMMITS
-        ini = os.path.join(DATA_DIR, 'multi-channel.ini')
+    @classmethod
+    def setUpClass(cls):
+        # One mock, patched in for the whole class.  git.Repo(path) returns
+        # the mock itself, so tests can configure it directly.
+        cls.Repo = Mock()
+        cls.Repo.return_value = cls.Repo
+        cls.Repo.git_dir = REPO_DIR
+        cls.Repo.iter_commits.side_effect = \
+            lambda rev, max_count=None, reverse=False: \
+                COMMITS[:max_count][::-1] if reverse else COMMITS[:max_count]
+        cls._patcher = patch('git.Repo', new=cls.Repo)
+        cls._patcher.start()
+        # The plugin reads this configuration as it's loaded for each test.
         conf.supybot.plugins.Git.pollPeriod.setValue(0)
         conf.supybot.plugins.Git.maxCommitsAtOnce.setValue(3)
-        conf.supybot.plugins.Git.configFile.setValue(ini)
-        self.assertResponse('rehash', 'Git reinitialized with 3 repositories.')
+        conf.supybot.plugins.Git.configFile.setValue(MULTI_CHANNEL_INI)
 
-    def tearDown(self):
-        del self.Repo
-        self._metamock.__exit__()
+    @classmethod
+    def tearDownClass(cls):
+        cls._patcher.stop()
+        del cls.Repo
+
+    def setUp(self):
+        # Reset before the plugin loads (and opens its repositories).  Only
+        # testSnarf changes what commit() returns.
+        self.Repo.reset_mock()
+        self.Repo.commit.return_value = COMMITS[0]
+        super(GitLogTest, self).setUp()
+        self.assertRepositoriesLoaded(3)
 
     def testLogNonexistent(self):
         expected = ['No configured repository named nothing.']
@@ -172,17 +350,10 @@ class GitLogTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         expected = ['Sorry, not allowed in this channel.']
         self.assertResponses('log test1', expected)
 
-    def testLogZero(self):
-        expected = ['(\x02log <short name> [count]\x02) -- Display the last ' +
-                    'commits on the named repository. [count] defaults to 1 ' +
-                    'if unspecified.']
-        self.assertResponses('log test2 0', expected)
-
-    def testLogNegative(self):
-        expected = ['(\x02log <short name> [count]\x02) -- Display the last ' +
-                    'commits on the named repository. [count] defaults to 1 ' +
-                    'if unspecified.']
-        self.assertResponses('log test2 -1', expected)
+    def testLogBadCount(self):
+        expected = [LOG_USAGE]
+        for count in ('0', '-1'):
+            self.assertResponses('log test2 ' + count, expected)
 
     def testLogOne(self):
         expected = ['[test2|feature|nstark] Fix bugs.']
@@ -212,4 +383,566 @@ class GitLogTest(ChannelPluginTestCase, PluginTestCaseUtilMixin):
         self.assertResponses('who wants some deadbeef?', expected,
                              usePrefixChar=False)
 
+def in_thread(function):
+    "Call function in another thread, and return its result."
+    result = []
+    worker = threading.Thread(target=lambda: result.append(function()))
+    worker.start()
+    worker.join(5)
+    return result[0]
+
+class RWLockTest(SupyTestCase):
+
+    def setUp(self):
+        super(RWLockTest, self).setUp()
+        self.lock = plugin.RWLock()
+
+    def testReadersShare(self):
+        with self.lock.reader:
+            self.failUnless(in_thread(
+                lambda: self.lock.acquire_read(blocking=False)))
+
+    def testWriterExcludes(self):
+        with self.lock.writer:
+            self.failIf(in_thread(
+                lambda: self.lock.acquire_read(blocking=False)))
+            self.failIf(in_thread(
+                lambda: self.lock.acquire_write(blocking=False)))
+
+    def testReaderBlocksWriter(self):
+        with self.lock.reader:
+            self.failIf(in_thread(
+                lambda: self.lock.acquire_write(blocking=False)))
+        self.failUnless(in_thread(
+            lambda: self.lock.acquire_write(blocking=False)))
+
+    def testReentrant(self):
+        with self.lock.writer:
+            with self.lock.writer:
+                with self.lock.reader:
+                    pass
+            # Still held after the inner sides are released
+            self.failIf(in_thread(
+                lambda: self.lock.acquire_read(blocking=False)))
+        with self.lock.reader:
+            with self.lock.reader:
+                pass
+            self.failIf(in_thread(
+                lambda: self.lock.acquire_write(blocking=False)))
+        self.failUnless(in_thread(
+            lambda: self.lock.acquire_write(blocking=False)))
+
+    def testWriterPreference(self):
+        acquired = threading.Event()
+        def write():
+            with self.lock.writer:
+                acquired.set()
+        self.lock.acquire_read()
+        writer = threading.Thread(target=write)
+        writer.start()
+        deadline = time.time() + 5
+        while not self.lock._writers_waiting and time.time() < deadline:
+            time.sleep(0.001)
+        # New readers wait for the writer, but existing ones can go on.
+        self.failIf(in_thread(lambda: self.lock.acquire_read(blocking=False)))
+        self.failUnless(self.lock.acquire_read(blocking=False))
+        self.lock.release_read()
+        self.failIf(acquired.isSet())
+        self.lock.release_read()
+        writer.join(5)
+        self.failUnless(acquired.isSet())
+
+# Stands in for git on the PATH in RunGitTest
+FAKE_GIT = """#!/bin/sh
+case "$1" in
+    hang) sleep 30 & echo $! > helper.pid; wait;;
+    fail) echo 'bad things' >&2; exit 3;;
+    *) echo "ran $*";;
+esac
+"""
+
+class RunGitTest(SupyTestCase):
+
+    def setUp(self):
+        super(RunGitTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        fake = os.path.join(self.dir, 'git')
+        with open(fake, 'w') as f:
+            f.write(FAKE_GIT)
+        os.chmod(fake, 0755)
+        path = self.dir + os.pathsep + os.environ.get('PATH', '')
+        self._patcher = patch.dict(os.environ, {'PATH': path})
+        self._patcher.start()
+
+    def tearDown(self):
+        self._patcher.stop()
+        shutil.rmtree(self.dir, True)
+        super(RunGitTest, self).tearDown()
+
+    def _gone(self, pid):
+        "Whether the process has exited (a zombie counts)."
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        try:
+            return open('/proc/%d/stat' % pid).read().split()[2] == 'Z'
+        except IOError:
+            return True
+
+    def testOutput(self):
+        self.assertEqual(plugin.run_git(['log', '-1'], self.dir, 5),
+                         'ran log -1\n')
+
+    def testFailure(self):
+        try:
+            plugin.run_git(['fail'], self.dir, 5)
+        except Exception, e:
+            self.assertEqual(str(e), 'git fail failed: bad things')
+        else:
+            self.fail('run_git did not raise')
+
+    def testTimeout(self):
+        start = time.time()
+        try:
+            plugin.run_git(['hang'], self.dir, 1)
+        except Exception, e:
+            self.assertEqual(str(e), 'git hang timed out after 1 seconds')
+        else:
+            self.fail('run_git did not raise')
+        self.failUnless(time.time() - start < 5)
+        # Helpers it started are killed along with it.
+        pid = int(open(os.path.join(self.dir, 'helper.pid')).read())
+        deadline = time.time() + 5
+        while not self._gone(pid) and time.time() < deadline:
+            time.sleep(0.01)
+        self.failUnless(self._gone(pid))
+
+def real_clone(self, *args, **kwargs):
+    "Git.clone as it is without the global mock: a plain git command."
+    return self._call_process('clone', *args, **kwargs)
+
+class RepositoryCommitsTest(SupyTestCase):
+    "get_new_commits against a real clone of a real (local) repository."
+
+    def setUp(self):
+        super(RepositoryCommitsTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.dir, 'upstream')
+        os.makedirs(self.upstream)
+        self._git('init', '--quiet')
+        self.base = self._commit('Initial commit.')
+        self._patchers = [
+            patch('git.Repo', new=REAL_REPO),
+            patch.object(git.Git, 'clone', new=real_clone),
+            patch.object(plugin, 'GIT_API_VERSION', GIT_API_VERSION),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+        options = {
+            'short name': 'test',
+            'url': self.upstream,
+            'channels': '#test',
+        }
+        self.repository = plugin.Repository(
+            os.path.join(self.dir, 'repositories'), 'Test Repository',
+            options)
+        self.repository.clone()
+
+    def tearDown(self):
+        self.repository.close()
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+        shutil.rmtree(self.dir, True)
+        super(RepositoryCommitsTest, self).tearDown()
+
+    def _git(self, *args):
+        return subprocess.check_output(
+            ['git', '-c', 'user.name=nstark',
+             '-c', 'user.email=nstark@example.com'] + list(args),
+            cwd=self.upstream)
+
+    def _commit(self, message):
+        "Commit the message upstream, and return the new SHA."
+        path = os.path.join(self.dir, 'message')
+        with open(path, 'w') as f:
+            f.write(message)
+        self._git('commit', '--quiet', '--allow-empty',
+                  '--allow-empty-message', '--cleanup=verbatim', '-F', path)
+        return self._git('rev-parse', 'HEAD').strip()
+
+    def _ids(self, commits):
+        return [commit.id for commit in commits]
+
+    def testMessages(self):
+        # Git won't store a NUL in a message, but any other separator the
+        # log output uses could turn up in one.
+        messages = [
+            'Subject\n\nA body\x1fwith a unit separator\n\nand more.\n',
+            '',
+            'Trailing\n\n\n',
+        ]
+        shas = [self._commit(message) for message in messages]
+        self.repository.fetch(30)
+        count, commits = self.repository.get_new_commits(10)
+        self.assertEqual(count, 3)
+        self.assertEqual(
+            [(c.id, c.author, c.message) for c in commits],
+            [(sha, ('nstark', 'nstark@example.com'), message)
+             for sha, message in zip(shas, messages)])
+
+    def testTooMany(self):
+        shas = [self._commit('Commit %d' % i) for i in range(5)]
+        self.repository.fetch(30)
+        count, commits = self.repository.get_new_commits(3)
+        self.assertEqual(count, 5)
+        self.assertEqual(self._ids(commits), shas[2:])
+        self.assertEqual(self.repository.last_commit, shas[-1])
+
+    def testNothingNew(self):
+        sha = self._commit('Fix bugs.')
+        self.repository.fetch(30)
+        count, commits = self.repository.get_new_commits(3)
+        self.assertEqual((count, self._ids(commits)), (1, [sha]))
+        self.assertEqual(self.repository.get_new_commits(3), (0, []))
+        # A fetch that brings nothing still makes git look.
+        self.repository.fetch(30)
+        self.assertEqual(self.repository.get_new_commits(3), (0, []))
+        self.assertEqual(self.repository.last_commit, sha)
+
+    def testRewound(self):
+        self._commit('Oops.')
+        self._commit('Oops again.')
+        self.repository.fetch(30)
+        self.assertEqual(self.repository.get_new_commits(3)[0], 2)
+        self._git('reset', '--quiet', '--hard', self.base)
+        self.repository.fetch(30)
+        self.assertEqual(self.repository.get_new_commits(3), (0, []))
+        self.assertEqual(self.repository.last_commit, self.base)
+        # Commits on top of the rewound branch are still announced.
+        sha = self._commit('Done right.')
+        self.repository.fetch(30)
+        count, commits = self.repository.get_new_commits(3)
+        self.assertEqual((count, self._ids(commits)), (1, [sha]))
+
+class GenerationTest(SupyTestCase):
+    "get_new_commits only starts git when a fetch may have brought commits."
+
+    def setUp(self):
+        super(GenerationTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self._patcher = patch.object(plugin, 'GIT_API_VERSION',
+                                     GIT_API_VERSION)
+        self._patcher.start()
+        options = {
+            'short name': 'test',
+            'url': 'https://example.com/test.git',
+            'channels': '#test',
+        }
+        self.repository = plugin.Repository(self.dir, 'Test Repository',
+                                            options)
+        self.repository.repo = Mock()
+        self.repository.repo.git.log.return_value = ''
+        self.repository.repo.git.rev_parse.return_value = COMMITS[0].hexsha
+        self.repository.last_commit = COMMITS[0].hexsha
+        self.repository.ready = True
+
+    def tearDown(self):
+        self._patcher.stop()
+        shutil.rmtree(self.dir, True)
+        super(GenerationTest, self).tearDown()
+
+    def testUnfetched(self):
+        self.assertEqual(self.repository.get_new_commits(3), (0, []))
+        self.assertEqual(self.repository.repo.git.log.call_count, 0)
+        self.assertEqual(self.repository.repo.git.rev_parse.call_count, 0)
+
+    def testFetched(self):
+        self.repository.generation += 1
+        self.assertEqual(self.repository.get_new_commits(3), (0, []))
+        self.assertEqual(self.repository.repo.git.log.call_count, 1)
+        # Until the next fetch, git isn't needed again.
+        self.assertEqual(self.repository.get_new_commits(3), (0, []))
+        self.assertEqual(self.repository.repo.git.log.call_count, 1)
+        self.repository.generation += 1
+        self.repository.get_new_commits(3)
+        self.assertEqual(self.repository.repo.git.log.call_count, 2)
+
+class RemoteChangedTest(SupyTestCase):
+    "The fetcher only fetches once ls-remote shows a branch has moved."
+
+    HEADS = COMMITS[0].hexsha + '\trefs/heads/master\n'
+    MOVED = COMMITS[1].hexsha + '\trefs/heads/master\n'
+
+    def setUp(self):
+        super(RemoteChangedTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.commands = []
+        self.heads = self.HEADS
+        self._patchers = [
+            patch.object(plugin, 'GIT_API_VERSION', GIT_API_VERSION),
+            patch.object(plugin, 'run_git', new=self._run_git),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+        options = {
+            'short name': 'test',
+            'url': 'https://example.com/test.git',
+            'channels': '#test',
+        }
+        self.repository = plugin.Repository(self.dir, 'Test Repository',
+                                            options)
+        self.repository.repo = Mock()
+        self.repository.ready = True
+        self.fetcher = plugin.GitFetcher([self.repository], 0)
+
+    def tearDown(self):
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+        shutil.rmtree(self.dir, True)
+        super(RemoteChangedTest, self).tearDown()
+
+    def _run_git(self, args, cwd, timeout):
+        self.commands.append(args[0])
+        if args[0] == 'ls-remote':
+            return self.heads
+        return ''
+
+    def _fetch(self):
+        "Run one fetch, and return the git commands it ran."
+        del self.commands[:]
+        self.fetcher._fetch(self.repository)
+        return self.commands
+
+    def testRemoteChanged(self):
+        self.assertEqual(self.repository.remote_changed(5), True)
+        self.assertEqual(self.repository.remote_changed(5), False)
+        self.heads = self.MOVED
+        self.assertEqual(self.repository.remote_changed(5), True)
+        self.assertEqual(self.repository.remote_changed(5), False)
+
+    def testFetchSkipped(self):
+        generation = self.repository.generation
+        self.assertEqual(self._fetch(), ['ls-remote', 'fetch'])
+        self.assertEqual(self.repository.generation, generation + 1)
+        self.assertEqual(self._fetch(), ['ls-remote'])
+        self.assertEqual(self.repository.generation, generation + 1)
+        self.heads = self.MOVED
+        self.assertEqual(self._fetch(), ['ls-remote', 'fetch'])
+        self.assertEqual(self.repository.generation, generation + 2)
+
+    def testFetchAfterError(self):
+        self._fetch()
+        self.repository.record_error(Exception('fetch failed'))
+        self.assertEqual(self._fetch(), ['ls-remote', 'fetch'])
+
+class CoalesceTest(SupyTestCase):
+
+    def testPacked(self):
+        lines = ['a' * 200, 'b' * 100, 'c' * 94, 'd']
+        self.assertEqual(plugin.coalesce_lines(lines),
+                         [' | '.join(lines[:3]), 'd'])
+
+    def testLongLineAlone(self):
+        lines = ['a', 'b' * 500, 'c']
+        self.assertEqual(plugin.coalesce_lines(lines), lines)
+
+class GitPollTest(ChannelPluginTestCase):
+    channel = '#test'
+    plugins = ('Git',)
+
+    @classmethod
+    def setUpClass(cls):
+        super(GitPollTest, cls).setUpClass()
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.maxCommitsAtOnce.setValue(3)
+        conf.supybot.plugins.Git.configFile.setValue(EMPTY_INI)
+
+    def tearDown(self):
+        # The registry is shared, so don't leak the setting to other tests.
+        conf.supybot.plugins.Git.coalesceLines.setValue(False)
+        super(GitPollTest, self).tearDown()
+
+    def _poll(self, coalesce):
+        "Announce two commits, and return the messages sent."
+        conf.supybot.plugins.Git.coalesceLines.setValue(coalesce)
+        cb = self.irc.getCallback('Git')
+        cb._read_settings()
+        repository = Mock()
+        repository.channels = frozenset([self.channel])
+        repository.lock.acquire_write.return_value = True
+        repository.get_errors.return_value = []
+        repository.get_new_commits.return_value = (2, ['one', 'two'])
+        repository.format_message.side_effect = \
+            lambda commit: ['Commit %s' % commit, 'View: %s' % commit]
+        cb._poll([repository])
+        messages = []
+        msg = self.irc.takeMsg()
+        while msg:
+            messages.append((msg.args[0], msg.args[1]))
+            msg = self.irc.takeMsg()
+        return messages
+
+    def testLines(self):
+        expected = [(self.channel, line) for line in
+                    ['Commit one', 'View: one', 'Commit two', 'View: two']]
+        self.assertEqual(self._poll(False), expected)
+
+    def testCoalesced(self):
+        expected = [
+            (self.channel, 'Commit one | View: one | Commit two | View: two'),
+        ]
+        self.assertEqual(self._poll(True), expected)
+
+class GitSnarfCacheTest(ChannelPluginTestCase):
+    channel = '#test'
+    plugins = ('Git',)
+
+    @classmethod
+    def setUpClass(cls):
+        super(GitSnarfCacheTest, cls).setUpClass()
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.configFile.setValue(EMPTY_INI)
+
+    def setUp(self):
+        super(GitSnarfCacheTest, self).setUp()
+        self.repository = Mock()
+        self.repository.generation = 1
+        self.repository.get_commit.return_value = None
+        self._install()
+
+    def _install(self):
+        "Make self.repository the only one in the channel."
+        cb = self.irc.getCallback('Git')
+        cb.repositories_by_channel = {self.channel: [self.repository]}
+
+    def _snarf(self, sha='deadbeef'):
+        "Snarf the SHA, and return how many times it has been looked up."
+        cb = self.irc.getCallback('Git')
+        msg = ircmsgs.privmsg(self.channel, sha, prefix=self.prefix)
+        cb._snarf(self.irc, msg, re.match(r'(?P<sha>[0-9a-f]+)', sha))
+        return self.repository.get_commit.call_count
+
+    def testMissCached(self):
+        self.assertEqual(self._snarf(), 1)
+        self.assertEqual(self._snarf(), 1)
+        # Another SHA is looked up as usual.
+        self.assertEqual(self._snarf('abcdef0'), 2)
+
+    def testFetchInvalidates(self):
+        self.assertEqual(self._snarf(), 1)
+        self.repository.generation += 1
+        self.assertEqual(self._snarf(), 2)
+        self.assertEqual(self._snarf(), 2)
+
+    def testRehashClears(self):
+        self.assertEqual(self._snarf(), 1)
+        # An unchanged file isn't reloaded, so rehash with another one.
+        fd, config = tempfile.mkstemp(suffix='.ini')
+        os.close(fd)
+        try:
+            conf.supybot.plugins.Git.configFile.setValue(config)
+            self.assertResponse('rehash',
+                                'Git reinitialized with 0 repositories.')
+        finally:
+            conf.supybot.plugins.Git.configFile.setValue(EMPTY_INI)
+            os.remove(config)
+        cb = self.irc.getCallback('Git')
+        self.assertEqual(cb.unknown_shas.get((self.channel, 'deadbeef')), None)
+        self._install()
+        self.assertEqual(self._snarf(), 2)
+
+class NextBatchTest(SupyTestCase):
+
+    def testDivisorOne(self):
+        items = range(5)
+        self.assertEqual(plugin.next_batch(items, 0, 1), (items, 0))
+
+    def testUneven(self):
+        # Batches are rounded up, so every item is covered in two.
+        items = range(5)
+        self.assertEqual(plugin.next_batch(items, 0, 2), ([0, 1, 2], 3))
+        self.assertEqual(plugin.next_batch(items, 3, 2), ([3, 4, 0], 1))
+
+    def testMoreBatchesThanItems(self):
+        self.assertEqual(plugin.next_batch(range(2), 1, 5), ([1], 0))
+
+    def testWrapAround(self):
+        items = range(6)
+        cursor = 0
+        batches = []
+        for i in range(4):
+            batch, cursor = plugin.next_batch(items, cursor, 3)
+            batches.append(batch)
+        self.assertEqual(batches, [[0, 1], [2, 3], [4, 5], [0, 1]])
+
+    def testShrunk(self):
+        # The cursor may be past the end if repositories were removed.
+        self.assertEqual(plugin.next_batch(range(3), 4, 2), ([1, 2], 0))
+        self.assertEqual(plugin.next_batch([], 4, 2), ([], 0))
+
+class GitFormatTest(PluginTestCase):
+    plugins = ('Git',)
+
+    @classmethod
+    def setUpClass(cls):
+        # Loading the plugin also sets up its GitPython API version.
+        super(GitFormatTest, cls).setUpClass()
+        conf.supybot.plugins.Git.pollPeriod.setValue(0)
+        conf.supybot.plugins.Git.configFile.setValue(EMPTY_INI)
+
+    def setUp(self):
+        super(GitFormatTest, self).setUp()
+        self.repo_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir, True)
+        super(GitFormatTest, self).tearDown()
+
+    def _format(self, message, link=''):
+        options = {
+            'short name': 'test',
+            'url': 'https://example.com/test.git',
+            'channels': '#test',
+            'branch': 'feature',
+            'commit link': link,
+            'commit message': message,
+        }
+        repository = plugin.Repository(self.repo_dir, 'Test Repository',
+                                       options)
+        return repository.format_message(COMMITS[0])
+
+    def testSubstitutions(self):
+        self.assertEqual(self._format('%a <%e> %c %C %m'),
+            ['nstark <nstark@example.com> abcdefa ' + COMMITS[0].hexsha +
+             ' Fix bugs.'])
+        self.assertEqual(self._format('%s %b %n %u'),
+            ['test feature Test Repository https://example.com/test.git'])
+
+    def testPercent(self):
+        self.assertEqual(self._format('100%% done, %%s'), ['100% done, %s'])
+
+    def testUnknownEscape(self):
+        self.assertEqual(self._format('%x%y %m'), ['xy Fix bugs.'])
+
+    def testTrailingPercent(self):
+        self.assertEqual(self._format('%m%'), ['Fix bugs.'])
+
+    def testAttributes(self):
+        self.assertEqual(self._format('%!%(4)%m%(4,1)!%r'),
+                         ['\x02\x034Fix bugs.\x034,1!\x0f'])
+        # An unterminated color produces nothing
+        self.assertEqual(self._format('%m%(4'), ['Fix bugs.'])
+
+    def testLines(self):
+        self.assertEqual(self._format('%m\n%s'), ['Fix bugs.', 'test'])
+
+    def testLink(self):
+        link = 'https://example.com/%c/%C?%x%%'
+        self.assertEqual(self._format('%l', link),
+            ['https://example.com/abcdefa/%s?x%%' % COMMITS[0].hexsha])
+        self.assertEqual(self._format('View: %l', link + '%'),
+            ['View: https://example.com/abcdefa/%s?x%%' % COMMITS[0].hexsha])
+        self.assertEqual(self._format('View: %l'), ['View: '])
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: